@@ -2,10 +2,20 @@
 Evaluation harness for questionnaire scoring agent.
 """
 
-import json
-import pandas as pd
-from typing import Dict, List
-from questionnaire_scorer import QuestionnaireScorer
+import asyncio
+import hashlib
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import orjson
+from typing import TYPE_CHECKING, Dict, FrozenSet, List, Set, Tuple, Union
+from questionnaire_scorer import AsyncQuestionnaireScorer, CACHE_DIR, clear_cache
+
+# numpy and pandas are imported where they are used, so the usage message and
+# 'cache clear' don't pay for them
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 THRESHOLDS = {
@@ -21,8 +31,59 @@ THRESHOLDS = {
 }
 
 
-def calculate_eval_metrics(predicted: Dict, expected: Dict) -> Dict:
-    """Compare agent output to ground truth."""
+def load_eval_dataset(eval_dataset_path: str) -> List[Dict]:
+    """
+    Load an eval dataset and prepare it for repeated metric calculation.
+    
+    Expected question texts are normalized (stripped, lowercased) in place and
+    each case gets a frozenset of them under '_exp_q_set', so
+    calculate_eval_metrics never re-normalizes the ground truth.
+    
+    Malformed cases are left untouched with '_exp_q_set' set to None; they
+    then fail inside run_evals and show up as error rows like any other case.
+    """
+    eval_dataset = orjson.loads(Path(eval_dataset_path).read_bytes())
+    
+    for eval_case in eval_dataset:
+        try:
+            expected = eval_case["expected_output"]
+            questions = [
+                {
+                    sys.intern(key): sys.intern(value.strip().lower()) if key == "question_text" else value
+                    for key, value in q.items()
+                }
+                for q in expected["questions"]
+            ]
+            exp_q_set = frozenset(q["question_text"] for q in questions)
+        except (KeyError, TypeError, AttributeError):
+            eval_case["_exp_q_set"] = None
+            continue
+        
+        expected["questions"] = questions
+        eval_case["_exp_q_set"] = exp_q_set
+    
+    return eval_dataset
+
+
+def document_key(doc_path: str) -> str:
+    """Hash a document's contents, so cases sharing a document can share one score."""
+    with open(doc_path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def calculate_eval_metrics(predicted: Dict, expected: Dict, exp_questions: FrozenSet[str] = None) -> Dict:
+    """
+    Compare agent output to ground truth.
+    
+    Args:
+        predicted: Agent output with 'questions' and 'section_averages'
+        expected: Ground truth in the same format
+        exp_questions: The '_exp_q_set' of a case from load_eval_dataset().
+            When given, expected's question texts are taken as already
+            normalized; otherwise they are normalized here.
+    """
+    import numpy as np
+    
     metrics = {
         "extraction_accuracy": 0.0,
         "score_mae": {},
@@ -30,37 +91,44 @@ def calculate_eval_metrics(predicted: Dict, expected: Dict) -> Dict:
         "section_detection": 0.0,
     }
     
+    # Normalize question texts once; keep the first predicted question per text
+    pred_by_text = {}
+    for q in predicted["questions"]:
+        pred_by_text.setdefault(q["question_text"].strip().lower(), q)
+    if exp_questions is None:
+        exp_norm = [(q, q["question_text"].strip().lower()) for q in expected["questions"]]
+        exp_questions = frozenset(exp_text for _, exp_text in exp_norm)
+    else:
+        exp_norm = [(q, q["question_text"]) for q in expected["questions"]]
+    
     # Question extraction accuracy
-    pred_questions = {q["question_text"].strip().lower() for q in predicted["questions"]}
-    exp_questions = {q["question_text"].strip().lower() for q in expected["questions"]}
+    pred_questions = pred_by_text.keys()
     
     if len(exp_questions) > 0:
         metrics["extraction_accuracy"] = len(pred_questions & exp_questions) / len(exp_questions)
     
     # Scoring accuracy for matched questions
     attributes = ["clarity", "specificity", "bias", "actionability"]
+    pairs = [(pred_by_text[exp_text], exp_q) for exp_q, exp_text in exp_norm if exp_text in pred_by_text]
     
-    for attr in attributes:
-        errors = []
-        within_1 = []
-        
-        for exp_q in expected["questions"]:
-            exp_text = exp_q["question_text"].strip().lower()
-            
-            # Find matching predicted question
-            pred_q = next(
-                (q for q in predicted["questions"] 
-                 if q["question_text"].strip().lower() == exp_text),
-                None
-            )
-            
-            if pred_q:
-                error = abs(pred_q[attr] - exp_q[attr])
-                errors.append(error)
-                within_1.append(error <= 1)
+    if pairs:
+        # One pass over the matches fills a (n_matched, 2, n_attributes) tensor
+        # holding predicted ([:, 0]) and expected ([:, 1]) scores
+        scores = np.fromiter(
+            (q[attr] for pair in pairs for q in pair for attr in attributes),
+            dtype=np.float64,
+            count=len(pairs) * 2 * len(attributes),
+        ).reshape(-1, 2, len(attributes))
         
-        metrics["score_mae"][attr] = sum(errors) / len(errors) if errors else 0.0
-        metrics["score_within_1"][attr] = sum(within_1) / len(within_1) if within_1 else 0.0
+        err = np.abs(scores[:, 0] - scores[:, 1])
+        mae = err.mean(axis=0)
+        within_1 = (err <= 1).mean(axis=0)
+    else:
+        mae = within_1 = np.zeros(len(attributes))
+    
+    for i, attr in enumerate(attributes):
+        metrics["score_mae"][attr] = float(mae[i])
+        metrics["score_within_1"][attr] = float(within_1[i])
     
     # Section detection
     if expected.get("section_averages"):
@@ -73,71 +141,214 @@ def calculate_eval_metrics(predicted: Dict, expected: Dict) -> Dict:
 
 
 class EvalHarness:
-    def __init__(self, eval_dataset_path: str):
-        self.eval_dataset = json.load(open(eval_dataset_path))
-        self.scorer = QuestionnaireScorer()
+    def __init__(self, eval_dataset_path: str, max_concurrency: int = 8, use_cache: bool = True):
+        self.eval_dataset = load_eval_dataset(eval_dataset_path)
+        self.scorer = AsyncQuestionnaireScorer(use_cache=use_cache)
+        self.max_concurrency = max_concurrency
+        self.metric_means: Dict[str, float] = {}
     
-    def run_evals(self) -> pd.DataFrame:
+    def run_evals(self) -> "pd.DataFrame":
         """Run agent on all eval cases."""
-        results = []
+        # Running (sum, count) per metric, updated as each case finishes
+        self._metric_totals = defaultdict(lambda: [0.0, 0])
+        results = asyncio.run(self._run_evals_async())
+        self._update_metric_means()
+        
+        import pandas as pd
+        return pd.DataFrame(results)
+    
+    def run_evals_batched(self, poll_interval: float = 30.0) -> "pd.DataFrame":
+        """
+        Run agent on all eval cases through one Message Batches API submission.
+        
+        Cheaper than run_evals for large datasets but only returns once the
+        whole batch has finished, so it is meant for nightly runs.
+        """
+        self._metric_totals = defaultdict(lambda: [0.0, 0])
         
+        # Submit each distinct document once, however many cases share it
+        unique_docs: Dict[str, str] = {}
+        case_keys = []
         for eval_case in self.eval_dataset:
-            eval_id = eval_case["id"]
-            print(f"\n{'='*60}")
-            print(f"Running eval: {eval_id}")
-            print(f"{'='*60}")
-            
             try:
-                # Get agent prediction (save CSV for each document)
-                predicted = self.scorer.score_document(eval_case["document"], save_csv=True)
-                expected = eval_case["expected_output"]
-                
-                # Calculate metrics
-                metrics = calculate_eval_metrics(predicted, expected)
-                
-                # Flatten for DataFrame
-                result = {
-                    "eval_id": eval_id,
-                    "extraction_acc": metrics["extraction_accuracy"],
-                    "section_detection": metrics["section_detection"],
-                }
-                
-                # Add MAE metrics
-                for attr, mae in metrics["score_mae"].items():
-                    result[f"{attr}_mae"] = mae
-                
-                # Add within_1 metrics
-                for attr, within_1 in metrics["score_within_1"].items():
-                    result[f"{attr}_within_1"] = within_1
-                
-                results.append(result)
-                
-                # Print summary
-                print(f"\nExtraction Accuracy: {metrics['extraction_accuracy']:.1%}")
-                print(f"Section Detection: {metrics['section_detection']:.1%}")
-                print("\nScoring MAE:")
-                for attr, mae in metrics["score_mae"].items():
-                    print(f"  {attr}: {mae:.2f}")
-                
+                doc_key = document_key(eval_case["document"])
+                unique_docs.setdefault(doc_key, eval_case["document"])
             except Exception as e:
-                print(f"❌ ERROR in {eval_id}: {e}")
-                results.append({
-                    "eval_id": eval_id,
-                    "error": str(e)
-                })
+                doc_key = e
+            case_keys.append(doc_key)
+        
+        doc_results = asyncio.run(self.scorer.score_documents_batched(
+            list(unique_docs.values()),
+            save_csv=False,
+            poll_interval=poll_interval,
+        ))
+        by_key = dict(zip(unique_docs, doc_results))
+        predictions = [
+            doc_key if isinstance(doc_key, Exception) else by_key[doc_key]
+            for doc_key in case_keys
+        ]
+        
+        saved_csvs: Set[str] = set()
+        for eval_case, predicted in zip(self.eval_dataset, predictions):
+            self._save_case_csv(eval_case, predicted, saved_csvs)
         
+        with ThreadPoolExecutor() as pool:
+            evaluated = list(pool.map(self._evaluate_prediction, self.eval_dataset, predictions))
+        
+        # Print and record in dataset order once all workers are done
+        results = []
+        for result, summary in evaluated:
+            print(summary)
+            self._record_result(result)
+            results.append(result)
+        self._update_metric_means()
+        
+        import pandas as pd
         return pd.DataFrame(results)
     
-    def check_pass_fail(self, results_df: pd.DataFrame) -> bool:
-        """Check if evals pass defined thresholds."""
+    async def _run_evals_async(self) -> List[Dict]:
+        """Score all eval cases concurrently, at most max_concurrency at a time."""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        # document_key -> scoring task, shared by every case on that document
+        scoring: Dict[str, asyncio.Task] = {}
+        saved_csvs: Set[str] = set()
+        tasks = [
+            self._run_eval_case(eval_case, semaphore, scoring, saved_csvs)
+            for eval_case in self.eval_dataset
+        ]
+        return await asyncio.gather(*tasks)
+    
+    async def _run_eval_case(
+        self,
+        eval_case: Dict,
+        semaphore: asyncio.Semaphore,
+        scoring: Dict[str, asyncio.Task],
+        saved_csvs: Set[str],
+    ) -> Dict:
+        """Run the agent on one eval case and flatten its metrics."""
+        try:
+            # The first case on a document starts scoring it; later cases with
+            # the same content await that same task instead of calling Claude
+            doc_key = document_key(eval_case["document"])
+            if doc_key not in scoring:
+                scoring[doc_key] = asyncio.create_task(self._score_document(eval_case["document"], semaphore))
+            predicted = await scoring[doc_key]
+        except Exception as e:
+            predicted = e
+        
+        self._save_case_csv(eval_case, predicted, saved_csvs)
+        result, summary = self._evaluate_prediction(eval_case, predicted)
+        print(summary)
+        self._record_result(result)
+        return result
+    
+    async def _score_document(self, doc_path: str, semaphore: asyncio.Semaphore) -> Dict:
+        """Get the agent prediction for one document."""
+        async with semaphore:
+            return await self.scorer.score_document(doc_path, save_csv=False)
+    
+    def _save_case_csv(self, eval_case: Dict, predicted: Union[Dict, Exception], saved_csvs: Set[str]):
+        """
+        Save the CSV for a case's own document path, once per path.
+        
+        Deduped cases share one prediction, so this is done per case rather
+        than by the scorer, which only sees the first path with that content.
+        """
+        doc_path = eval_case.get("document")
+        if isinstance(predicted, Exception) or doc_path in saved_csvs:
+            return
+        
+        saved_csvs.add(doc_path)
+        try:
+            self.scorer.save_csv(predicted, f"scoring_results_{Path(doc_path).stem}.csv")
+        except OSError as e:
+            print(f"❌ Could not save CSV for {doc_path}: {e}")
+    
+    def _evaluate_prediction(self, eval_case: Dict, predicted: Union[Dict, Exception]) -> Tuple[Dict, str]:
+        """
+        Flatten the metrics for one eval case.
+        
+        predicted may be the exception scoring raised. Returns the result row
+        and its printable summary; callers print the summary themselves, so
+        worker threads never write to stdout.
+        """
+        eval_id = eval_case["id"]
+        
+        try:
+            if isinstance(predicted, Exception):
+                raise predicted
+            expected = eval_case["expected_output"]
+            
+            # Calculate metrics
+            metrics = calculate_eval_metrics(predicted, expected, eval_case.get("_exp_q_set"))
+            
+            # Flatten for DataFrame
+            result = {
+                "eval_id": eval_id,
+                "extraction_acc": metrics["extraction_accuracy"],
+                "section_detection": metrics["section_detection"],
+            }
+            
+            # Add MAE metrics
+            for attr, mae in metrics["score_mae"].items():
+                result[f"{attr}_mae"] = mae
+            
+            # Add within_1 metrics
+            for attr, within_1 in metrics["score_within_1"].items():
+                result[f"{attr}_within_1"] = within_1
+            
+            # Summary
+            lines = [
+                f"\n{'='*60}",
+                f"Eval: {eval_id}",
+                f"{'='*60}",
+                f"\nExtraction Accuracy: {metrics['extraction_accuracy']:.1%}",
+                f"Section Detection: {metrics['section_detection']:.1%}",
+                "\nScoring MAE:",
+            ]
+            for attr, mae in metrics["score_mae"].items():
+                lines.append(f"  {attr}: {mae:.2f}")
+            return result, "\n".join(lines)
+            
+        except Exception as e:
+            return {
+                "eval_id": eval_id,
+                "error": str(e)
+            }, f"❌ ERROR in {eval_id}: {e}"
+    
+    def _record_result(self, result: Dict):
+        """Add a successful result's metrics to the running totals."""
+        if "error" in result:
+            return
+        
+        for metric, value in result.items():
+            if metric != "eval_id":
+                totals = self._metric_totals[metric]
+                totals[0] += value
+                totals[1] += 1
+    
+    def _update_metric_means(self):
+        """Turn the running totals into per-metric means."""
+        self.metric_means = {
+            metric: total / count for metric, (total, count) in self._metric_totals.items()
+        }
+    
+    def check_pass_fail(self, means: Dict[str, float] = None) -> bool:
+        """
+        Check if evals pass defined thresholds.
+        
+        Args:
+            means: Average of each metric across eval cases; defaults to the
+                running means collected by the last run_evals() call
+        """
+        if means is None:
+            means = self.metric_means
+        
         print(f"\n{'='*60}")
         print("EVAL RESULTS SUMMARY")
         print(f"{'='*60}\n")
         
         # Show aggregate metrics
-        numeric_cols = results_df.select_dtypes(include=['float64', 'int64']).columns
-        means = results_df[numeric_cols].mean()
-        
         print("Average Metrics:")
         for col, val in means.items():
             print(f"  {col}: {val:.3f}")
@@ -179,20 +390,29 @@ class EvalHarness:
 
 
 if __name__ == "__main__":
-    import sys
+    args = sys.argv[1:]
+    use_cache = "--no-cache" not in args
+    batched = "--batch" in args
+    args = [arg for arg in args if arg not in ("--no-cache", "--batch")]
+    
+    if args[:2] == ["cache", "clear"]:
+        clear_cache()
+        print(f"Cleared response cache at {CACHE_DIR}")
+        sys.exit(0)
     
-    if len(sys.argv) < 2:
-        print("Usage: python eval_harness.py <path_to_eval_dataset.json>")
+    if len(args) < 1:
+        print("Usage: python eval_harness.py [--no-cache] [--batch] <path_to_eval_dataset.json>")
+        print("       python eval_harness.py cache clear")
         sys.exit(1)
     
-    harness = EvalHarness(sys.argv[1])
-    results_df = harness.run_evals()
+    harness = EvalHarness(args[0], use_cache=use_cache)
+    results_df = harness.run_evals_batched() if batched else harness.run_evals()
     
     # Save results
     results_df.to_csv("eval_results.csv", index=False)
     print(f"\nDetailed results saved to eval_results.csv")
     
     # Check pass/fail
-    passed = harness.check_pass_fail(results_df)
+    passed = harness.check_pass_fail()
     
     sys.exit(0 if passed else 1)
\ No newline at end of file
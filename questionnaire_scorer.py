@@ -3,15 +3,17 @@ Questionnaire Scoring Agent
 Extracts questions from documents and scores them on multiple attributes.
 """
 
-import anthropic
+# anthropic, httpx and python-docx are imported where they are used, so that
+# importing this module (e.g. from eval_harness) stays cheap
+import asyncio
 import base64
 import csv
-import io
+import diskcache
+import hashlib
 import json
 import os
 from pathlib import Path
-from typing import Dict, List
-from docx import Document
+from typing import Dict, List, Tuple, Union
 from dotenv import load_dotenv, find_dotenv
 
 # 1) load global/shared first
@@ -21,6 +23,59 @@ load_dotenv(find_dotenv(usecwd=True), override=True)
 
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 
+MODEL = "claude-sonnet-4-20250514"
+
+# Tool-call JSON repeats every field name per question, so this is sized well
+# above what the equivalent CSV needed
+MAX_TOKENS = 16000
+
+# On-disk cache of Claude's scores, keyed by model, prompt, tool schema and document bytes
+CACHE_DIR = os.path.expanduser("~/.cache/survey_eval")
+CACHE_TTL = 14 * 24 * 60 * 60  # seconds
+
+# One pooled HTTP/2 connection set per client, shared by concurrent requests
+HTTP_LIMITS = {"max_connections": 100, "max_keepalive_connections": 32}
+
+# WordprocessingML paragraph tag (Clark notation, as docx.oxml.ns.qn("w:p") builds it)
+W_P = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}p"
+
+# Scores reported per question, in saved-CSV column order
+SCORE_FIELDS = (
+    "clarity",
+    "specificity",
+    "bias",
+    "actionability",
+    "narrative_value",
+    "research_value",
+    "pivot_value",
+)
+QUESTION_FIELDS = ("section", "question_number", "question_text") + SCORE_FIELDS
+
+# Claude returns its scores by calling this tool, so the reply is already structured
+SCORES_TOOL = {
+    "name": "emit_scores",
+    "description": "Report every question extracted from the document with its section, number and scores.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "questions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "section": {"type": "string"},
+                        "question_number": {"type": "integer"},
+                        "question_text": {"type": "string"},
+                        **{field: {"type": "integer", "minimum": 1, "maximum": 5} for field in SCORE_FIELDS},
+                    },
+                    "required": list(QUESTION_FIELDS),
+                },
+            },
+        },
+        "required": ["questions"],
+    },
+}
+
 SCORING_PROMPT = """You are a questionnaire scoring agent. Your task:
 
 1. **Parse the input document**
@@ -68,29 +123,50 @@ SCORING_PROMPT = """You are a questionnaire scoring agent. Your task:
 
 
 
-3. **Output ONLY a CSV** with these exact columns:
-   Section,Question_Number,Question_Text,Clarity,Specificity,Bias,Actionability,Narrative_Value,Research_Value,Pivot_Value
+3. **Report the results** by calling the emit_scores tool once, with one entry per question:
+   section, question_number, question_text, clarity, specificity, bias, actionability, narrative_value, research_value, pivot_value
 
 **Rules**:
 - If no section is found, use "General" as the section name
 - Number questions sequentially within each section throughout the document
 - Pay attention to branching logic and update those numbers as you go
 - Include the question choices with the question text
-- Do NOT include section averages in the CSV (we'll calculate those separately)
-- Question_Text should be the exact text from the document
+- Do NOT include section averages (we'll calculate those separately)
+- question_text should be the exact text from the document
 - All scores must be integers 1-5
-- Output ONLY the CSV, no other text or markdown formatting
 
-**Example output format**:
-Section,Question_Number,Question_Text,Clarity,Specificity,Bias,Actionability,Narrative_Value,Research_Value,Pivot_Value
-Demographics,1,What is your age?,5,5,5,3,5,5,5
-Demographics,2,How satisfied are you with our amazing product?,4,2,2,3,3,3,3
+**Example question entries**:
+{"section": "Demographics", "question_number": 1, "question_text": "What is your age?", "clarity": 5, "specificity": 5, "bias": 5, "actionability": 3, "narrative_value": 5, "research_value": 5, "pivot_value": 5}
+{"section": "Demographics", "question_number": 2, "question_text": "How satisfied are you with our amazing product?", "clarity": 4, "specificity": 2, "bias": 2, "actionability": 3, "narrative_value": 3, "research_value": 3, "pivot_value": 3}
 """
 
+# Marked for Anthropic prompt caching so repeat calls only pay a cache read
+PROMPT_BLOCK = {"type": "text", "text": SCORING_PROMPT, "cache_control": {"type": "ephemeral"}}
+
+_CACHE_KEY_PREFIX = (MODEL + SCORING_PROMPT + json.dumps(SCORES_TOOL, sort_keys=True)).encode()
+
+
+def clear_cache():
+    """Remove all cached Claude responses."""
+    with diskcache.Cache(CACHE_DIR) as cache:
+        cache.clear()
+
 
 class QuestionnaireScorer:
-    def __init__(self, api_key: str = None):
-        self.client = anthropic.Anthropic(api_key=api_key)
+    def __init__(self, api_key: str = None, use_cache: bool = True):
+        self.client = self._make_client(api_key)
+        self.cache = diskcache.Cache(CACHE_DIR) if use_cache else None
+        self._doc_cache: Dict[Tuple[str, int], Tuple[str, List[Dict]]] = {}
+    
+    def _make_client(self, api_key: str = None):
+        """Create the Anthropic client; subclasses override for the async one."""
+        import anthropic
+        import httpx
+        
+        return anthropic.Anthropic(
+            api_key=api_key,
+            http_client=anthropic.DefaultHttpxClient(http2=True, limits=httpx.Limits(**HTTP_LIMITS)),
+        )
     
     def score_document(self, doc_path: str, save_csv: bool = True) -> Dict:
         """
@@ -98,18 +174,81 @@ class QuestionnaireScorer:
         
         Args:
             doc_path: Path to DOCX or PDF file
-            save_csv: Whether to save the raw CSV output to a file
+            save_csv: Whether to save the scored questions to a CSV file
             
         Returns:
             Dict with 'questions' list and 'section_averages' dict
         """
+        cache_key = self._cache_key(doc_path)
+        questions = self._cache_get(cache_key)
+        if questions is not None:
+            return self._finish(questions, doc_path, save_csv)
+        
+        # Call Claude
+        response = self.client.messages.create(**self._request_params(doc_path))
+        
+        results = self._finish(self._response_questions(response), doc_path, save_csv)
+        # Only cache replies that passed validation and parsing
+        self._cache_set(cache_key, results["questions"])
+        return results
+    
+    def _cache_key(self, doc_path: str) -> str:
+        """Hash the model, prompt, tool schema and document bytes into a cache key."""
+        with open(doc_path, "rb") as f:
+            doc_bytes = f.read()
+        return hashlib.sha256(_CACHE_KEY_PREFIX + doc_bytes).hexdigest()
+    
+    def _cache_get(self, key: str):
+        """Return the cached questions for key, or None on a miss or when caching is off."""
+        if self.cache is None:
+            return None
+        return self.cache.get(key)
+    
+    def _cache_set(self, key: str, questions: List[Dict]):
+        """Store questions under key if caching is on."""
+        if self.cache is not None:
+            self.cache.set(key, questions, expire=CACHE_TTL)
+    
+    def _request_params(self, doc_path: str) -> Dict:
+        """Build the messages.create parameters for scoring a document."""
+        return {
+            "model": MODEL,
+            "max_tokens": MAX_TOKENS,
+            "tools": [SCORES_TOOL],
+            "tool_choice": {"type": "tool", "name": SCORES_TOOL["name"]},
+            "messages": [{
+                "role": "user",
+                "content": self._build_content_blocks(doc_path)
+            }]
+        }
+    
+    def _build_content_blocks(self, doc_path: str) -> List[Dict]:
+        """Build the message content blocks for a DOCX or PDF document."""
+        _, doc_blocks = self._document_blocks(doc_path)
+        
+        # The static prompt goes first so it forms a bit-identical, cacheable
+        # prefix; the per-document blocks follow it
+        return [PROMPT_BLOCK] + doc_blocks
+    
+    def _document_blocks(self, doc_path: str) -> Tuple[str, List[Dict]]:
+        """
+        Return (suffix, content blocks) for the document itself, without the prompt.
+        
+        Results are memoized per path and modification time, so scoring the
+        same file again skips the DOCX extraction or PDF base64 encoding.
+        """
+        memo_key = (doc_path, os.stat(doc_path).st_mtime_ns)
+        cached = self._doc_cache.get(memo_key)
+        if cached is not None:
+            return cached
+        
         suffix = Path(doc_path).suffix.lower()
         
         # Handle DOCX - extract text first
         if suffix == ".docx":
             text_content = self._extract_docx_text(doc_path)
-            content_blocks = [
-                {"type": "text", "text": f"Here is the questionnaire document:\n\n{text_content}\n\n{SCORING_PROMPT}"}
+            doc_blocks = [
+                {"type": "text", "text": f"Here is the questionnaire document:\n\n{text_content}"}
             ]
         
         # Handle PDF - send as document
@@ -117,7 +256,7 @@ class QuestionnaireScorer:
             with open(doc_path, "rb") as f:
                 doc_data = base64.b64encode(f.read()).decode()
             
-            content_blocks = [
+            doc_blocks = [
                 {
                     "type": "document",
                     "source": {
@@ -125,100 +264,104 @@ class QuestionnaireScorer:
                         "media_type": "application/pdf",
                         "data": doc_data
                     }
-                },
-                {"type": "text", "text": SCORING_PROMPT}
+                }
             ]
         else:
             raise ValueError(f"Unsupported file format: {suffix}. Use .docx or .pdf")
         
-        # Call Claude
-        response = self.client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=4000,
-            messages=[{
-                "role": "user",
-                "content": content_blocks
-            }]
-        )
+        self._doc_cache[memo_key] = (suffix, doc_blocks)
+        return suffix, doc_blocks
+    
+    def _response_questions(self, response) -> List[Dict]:
+        """Extract and validate the question list from Claude's emit_scores tool call."""
+        if response.stop_reason == "max_tokens":
+            raise ValueError(f"Response was truncated at max_tokens={MAX_TOKENS}; scores are incomplete")
+        
+        for block in response.content:
+            if block.type == "tool_use" and block.name == SCORES_TOOL["name"]:
+                questions = block.input.get("questions")
+                break
+        else:
+            raise ValueError(f"Response did not call the {SCORES_TOOL['name']} tool")
         
-        # Parse CSV response
-        csv_text = response.content[0].text
-        csv_text = csv_text.strip()
+        if not isinstance(questions, list):
+            raise ValueError(f"{SCORES_TOOL['name']} input has no 'questions' list")
         
-        # Remove markdown formatting if present
-        if csv_text.startswith("```"):
-            lines = csv_text.split("\n")
-            csv_text = "\n".join(lines[1:-1]) if len(lines) > 2 else csv_text
+        for i, question in enumerate(questions):
+            if not isinstance(question, dict):
+                raise ValueError(f"Question {i + 1} in the response is not an object")
+            missing = [field for field in QUESTION_FIELDS if field not in question]
+            if missing:
+                raise ValueError(f"Question {i + 1} in the response is missing {', '.join(missing)}")
         
-        # Save raw CSV if requested
+        return questions
+    
+    def _finish(self, questions: List[Dict], doc_path: str, save_csv: bool) -> Dict:
+        """Optionally save the scored questions as CSV, then add section averages."""
+        results = {
+            "questions": questions,
+            "section_averages": self._compute_section_averages(questions)
+        }
+        
+        # Save CSV if requested
         if save_csv:
-            csv_filename = f"scoring_results_{Path(doc_path).stem}.csv"
-            with open(csv_filename, "w", encoding="utf-8") as f:
-                f.write(csv_text)
-            print(f"Raw CSV saved to: {csv_filename}")
+            self.save_csv(results, f"scoring_results_{Path(doc_path).stem}.csv")
         
-        return self._parse_csv_output(csv_text)
+        return results
     
     def _extract_docx_text(self, doc_path: str) -> str:
         """Extract text from DOCX file, preserving structure."""
+        from docx import Document
+        from docx.enum.style import WD_STYLE_TYPE
+        
         doc = Document(doc_path)
         text_parts = []
         
-        for para in doc.paragraphs:
-            text = para.text.strip()
+        # Resolve style ids to names once per document. The id is localized in
+        # non-English Word (e.g. "berschrift1") while the name stays "Heading 1"
+        style_names = {
+            style.style_id: style.name or ""
+            for style in doc.styles
+            if style.type == WD_STYLE_TYPE.PARAGRAPH
+        }
+        default_style = doc.styles.default(WD_STYLE_TYPE.PARAGRAPH)
+        default_name = (default_style.name or "") if default_style is not None else ""
+        
+        # Walk the body's paragraph elements directly rather than through the
+        # Paragraph/Style proxies, which re-resolve the style part per paragraph
+        for p in doc.element.body.iterchildren(W_P):
+            text = p.text.strip()
             if text:
                 # Check if it looks like a heading (bold or specific style)
-                if para.style.name.startswith('Heading'):
+                style_name = style_names.get(p.style, default_name) if p.style else default_name
+                if style_name.startswith("Heading"):
                     text_parts.append(f"\n## {text}\n")
                 else:
                     text_parts.append(text)
         
         return "\n".join(text_parts)
     
-    def _parse_csv_output(self, csv_text: str) -> Dict:
-        """Parse CSV string into structured format with section averages."""
-        reader = csv.DictReader(io.StringIO(csv_text))
-        questions = []
-        section_scores = {}
-        
-        for row in reader:
-            question = {
-                "section": row["Section"],
-                "question_number": int(row["Question_Number"]),
-                "question_text": row["Question_Text"],
-                "clarity": int(row["Clarity"]),
-                "specificity": int(row["Specificity"]),
-                "bias": int(row["Bias"]),
-                "actionability": int(row["Actionability"])
-            }
-            questions.append(question)
-            
-            # Collect scores by section
-            section = row["Section"]
-            if section not in section_scores:
-                section_scores[section] = {
-                    "clarity": [],
-                    "specificity": [],
-                    "bias": [],
-                    "actionability": []
-                }
-            
-            section_scores[section]["clarity"].append(int(row["Clarity"]))
-            section_scores[section]["specificity"].append(int(row["Specificity"]))
-            section_scores[section]["bias"].append(int(row["Bias"]))
-            section_scores[section]["actionability"].append(int(row["Actionability"]))
-        
-        # Calculate averages
-        section_averages = {}
-        for section, scores in section_scores.items():
-            section_averages[section] = {
-                attr: sum(vals) / len(vals)
-                for attr, vals in scores.items()
-            }
+    def _compute_section_averages(self, questions: List[Dict]) -> Dict:
+        """Average the scores of each section's questions."""
+        # Single pass: fold each question into its section's
+        # [count, clarity, specificity, bias, actionability] running sums
+        section_acc = {}
+        for question in questions:
+            acc = section_acc.setdefault(question["section"], [0, 0, 0, 0, 0])
+            acc[0] += 1
+            acc[1] += question["clarity"]
+            acc[2] += question["specificity"]
+            acc[3] += question["bias"]
+            acc[4] += question["actionability"]
         
         return {
-            "questions": questions,
-            "section_averages": section_averages
+            section: {
+                "clarity": acc[1] / acc[0],
+                "specificity": acc[2] / acc[0],
+                "bias": acc[3] / acc[0],
+                "actionability": acc[4] / acc[0],
+            }
+            for section, acc in section_acc.items()
         }
     
     def save_results(self, results: Dict, output_path: str):
@@ -226,22 +369,132 @@ class QuestionnaireScorer:
         with open(output_path, "w") as f:
             json.dump(results, f, indent=2)
     
-    def save_csv(self, csv_text: str, output_path: str):
-        """Save raw CSV text to file."""
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(csv_text)
+    def save_csv(self, results: Dict, output_path: str):
+        """Save the scored questions to a CSV file."""
+        with open(output_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            # Section,Question_Number,Question_Text,Clarity,...
+            writer.writerow(["_".join(part.capitalize() for part in field.split("_")) for field in QUESTION_FIELDS])
+            for question in results["questions"]:
+                writer.writerow([question.get(field) for field in QUESTION_FIELDS])
         print(f"CSV saved to: {output_path}")
 
 
+class AsyncQuestionnaireScorer(QuestionnaireScorer):
+    """QuestionnaireScorer backed by the async Anthropic client.
+    
+    Lets callers score many documents concurrently with asyncio.
+    """
+    
+    def _make_client(self, api_key: str = None):
+        import anthropic
+        import httpx
+        
+        return anthropic.AsyncAnthropic(
+            api_key=api_key,
+            http_client=anthropic.DefaultAsyncHttpxClient(http2=True, limits=httpx.Limits(**HTTP_LIMITS)),
+        )
+    
+    async def score_document(self, doc_path: str, save_csv: bool = True) -> Dict:
+        """Async version of QuestionnaireScorer.score_document."""
+        cache_key = self._cache_key(doc_path)
+        questions = self._cache_get(cache_key)
+        if questions is not None:
+            return self._finish(questions, doc_path, save_csv)
+        
+        response = await self.client.messages.create(**self._request_params(doc_path))
+        
+        results = self._finish(self._response_questions(response), doc_path, save_csv)
+        # Only cache replies that passed validation and parsing
+        self._cache_set(cache_key, results["questions"])
+        return results
+    
+    async def score_documents_batched(
+        self, doc_paths: List[str], save_csv: bool = True, poll_interval: float = 30.0
+    ) -> List[Union[Dict, Exception]]:
+        """
+        Score many documents with a single Message Batches API submission.
+        
+        Batches run at reduced cost but can take minutes to hours, so this
+        suits nightly eval runs rather than interactive use. Cached documents
+        are answered from the cache and left out of the batch.
+        
+        Args:
+            doc_paths: Paths to DOCX or PDF files
+            save_csv: Whether to save the scored questions of each document as CSV
+            poll_interval: Seconds between batch status checks
+            
+        Returns:
+            List aligned with doc_paths holding each document's result dict,
+            or the exception raised while scoring it
+        """
+        results: List[Union[Dict, Exception]] = [None] * len(doc_paths)
+        pending = {}
+        requests = []
+        
+        for i, doc_path in enumerate(doc_paths):
+            try:
+                cache_key = self._cache_key(doc_path)
+                questions = self._cache_get(cache_key)
+                if questions is not None:
+                    results[i] = self._finish(questions, doc_path, save_csv)
+                    continue
+                
+                # custom_id must be short and alphanumeric, so use the position
+                custom_id = f"doc-{i}"
+                requests.append({"custom_id": custom_id, "params": self._request_params(doc_path)})
+                pending[custom_id] = (i, doc_path, cache_key)
+                results[i] = RuntimeError(f"No batch result for {doc_path}")
+            except Exception as e:
+                results[i] = e
+        
+        if not requests:
+            return results
+        
+        batch = await self.client.messages.batches.create(requests=requests)
+        print(f"Submitted batch {batch.id} with {len(requests)} requests")
+        
+        while batch.processing_status != "ended":
+            await asyncio.sleep(poll_interval)
+            batch = await self.client.messages.batches.retrieve(batch.id)
+        
+        async for entry in await self.client.messages.batches.results(batch.id):
+            i, doc_path, cache_key = pending[entry.custom_id]
+            
+            if entry.result.type != "succeeded":
+                results[i] = RuntimeError(f"Batch request {entry.result.type} for {doc_path}")
+                continue
+            
+            try:
+                results[i] = self._finish(
+                    self._response_questions(entry.result.message), doc_path, save_csv
+                )
+                self._cache_set(cache_key, results[i]["questions"])
+            except Exception as e:
+                results[i] = e
+        
+        return results
+
+
 if __name__ == "__main__":
     import sys
     
-    if len(sys.argv) < 2:
-        print("Usage: python questionnaire_scorer.py <path_to_document>")
+    args = sys.argv[1:]
+    use_cache = "--no-cache" not in args
+    args = [arg for arg in args if arg != "--no-cache"]
+    
+    if args[:2] == ["cache", "clear"]:
+        clear_cache()
+        print(f"Cleared response cache at {CACHE_DIR}")
+        sys.exit(0)
+    
+    if len(args) < 1:
+        print("Usage: python questionnaire_scorer.py [--no-cache] <path_to_document>")
+        print("       python questionnaire_scorer.py cache clear")
         sys.exit(1)
     
-    scorer = QuestionnaireScorer()
-    results = scorer.score_document(sys.argv[1])
+    scorer = QuestionnaireScorer(use_cache=use_cache)
+    results = scorer.score_document(args[0])
     
     print("\n=== SCORING RESULTS ===\n")
     print(f"Found {len(results['questions'])} questions")
@@ -259,5 +512,5 @@ if __name__ == "__main__":
     print(f"\nFull results saved to {output_path}")
     
     # Note about CSV file
-    csv_filename = f"scoring_results_{Path(sys.argv[1]).stem}.csv"
-    print(f"Raw CSV data saved to {csv_filename}")
\ No newline at end of file
+    csv_filename = f"scoring_results_{Path(args[0]).stem}.csv"
+    print(f"Scored questions saved as CSV to {csv_filename}")
\ No newline at end of file